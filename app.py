@@ -1,4 +1,8 @@
+import copy
+import os
+
 import streamlit as st
+import numpy as np
 import pandas as pd
 import folium
 from streamlit_folium import st_folium
@@ -28,35 +32,255 @@ COMUNA_MAPPING = {
     'Puqueldon': 'Puqueldón'
 }
 
+COLS_AMPUTACION = [
+    'AMP_DEDO_MANO', 'AMP_PULGAR', 'AMP_DEDO_PIE', 'AMP_A_NIVEL_PIE',
+    'DESART_TOBILLO', 'AMP_NIVEL_MALEOLO', 'AMP_DEBAJO_RODILLA',
+    'DESART_RODILLA', 'AMP_ENCIMA_RODILLA'
+]
+
+# Dtypes explícitos del CSV: evita la inferencia de tipos al parsear
+CSV_DTYPES = {
+    'Codigo': 'string',
+    # float32 basta para coordenadas de mapa (precisión sub-métrica a esta
+    # latitud) y usa la mitad de memoria en todas las copias derivadas
+    'lat': 'float32',
+    'lng': 'float32',
+    'tiempo (minutos)': 'float64',
+    'km': 'float64',
+    'Numero de registros': 'int16',
+    'Mayor': 'int8',
+    'Menor': 'int8',
+    'Moderada': 'int8',
+    'Ultima Edad Registrada': 'int16',
+    'Total_Amputaciones': 'int8',
+    **{col: 'int8' for col in COLS_AMPUTACION}
+}
+
 # --- Carga de Datos de PUNTOS (CSV) ---
 @st.cache_data
 def load_data(csv_file_path):
+    # Cache binario en disco: los arranques en frío leen el Feather ya
+    # limpio en vez de re-parsear el CSV completo
+    feather_path = csv_file_path + '.feather'
+    try:
+        if os.path.getmtime(feather_path) >= os.path.getmtime(csv_file_path):
+            return pd.read_feather(feather_path)
+    except OSError:
+        pass
+
     try:
-        df = pd.read_csv(csv_file_path, sep=';')
+        df = pd.read_csv(csv_file_path, sep=';', engine='pyarrow', dtype=CSV_DTYPES)
     except FileNotFoundError:
         st.error(f"Error: No se encontró el archivo '{csv_file_path}'.")
         return pd.DataFrame()
 
     df['Comuna'] = df['Comuna'].replace(COMUNA_MAPPING)
     df = df[df['Comuna'].isin(COMUNAS_LLANQUIHUE)].copy()
-    df['lat'] = pd.to_numeric(df['lat'], errors='coerce')
-    df['lng'] = pd.to_numeric(df['lng'], errors='coerce')
+
+    # Columnas de baja cardinalidad como Categorical: menos memoria y
+    # filtros isin() sobre códigos enteros en vez de strings
+    for col in ('Comuna', 'Ultima registro severidad', 'Sexo (Desc)'):
+        df[col] = df[col].astype('category')
+
     df.dropna(subset=['lat', 'lng'], inplace=True)
+    df.reset_index(drop=True, inplace=True)
+
+    try:
+        df.to_feather(feather_path)
+    except OSError:
+        pass  # sistema de archivos de solo lectura: seguimos sin el cache
+
     return df
 
 # --- Carga de FORMAS (GeoJSON) ---
 @st.cache_data
 def load_shapes(geojson_path):
+    # Cache binario en disco: GeoParquet se lee mucho más rápido que
+    # re-parsear el GeoJSON en cada arranque en frío
+    parquet_path = geojson_path + '.parquet'
     try:
-        gdf_llanquihue = gpd.read_file(geojson_path)
-        gdf_llanquihue = gdf_llanquihue.to_crs(epsg=4326)
+        gdf_llanquihue = None
+        try:
+            if os.path.getmtime(parquet_path) >= os.path.getmtime(geojson_path):
+                gdf_llanquihue = gpd.read_parquet(parquet_path)
+        except OSError:
+            pass
+
+        if gdf_llanquihue is None:
+            gdf_llanquihue = gpd.read_file(geojson_path)
+            gdf_llanquihue = gdf_llanquihue.to_crs(epsg=4326)
+            # Simplificamos los polígonos (tolerancia ~50 m): muchos menos
+            # vértices que serializar al mapa, sin diferencia visible a
+            # nivel provincial
+            gdf_llanquihue['geometry'] = gdf_llanquihue.geometry.simplify(0.0005)
+            try:
+                gdf_llanquihue.to_parquet(parquet_path)
+            except OSError:
+                pass  # sistema de archivos de solo lectura: seguimos sin el cache
+
         return gdf_llanquihue
-        
+
     except Exception as e:
         st.error(f"Error al cargar el GeoJSON ('{geojson_path}'): {e}")
         st.info("Asegúrate de que 'llanquihue_comunas.geojson' esté en tu repositorio.")
         return None
 
+# Máscara de pertenencia sobre los códigos enteros de una columna
+# Categorical: compara int8/int16 en NumPy en vez de strings
+def _mask_categorias(serie, seleccion):
+    codigos_sel = serie.cat.categories.get_indexer(list(seleccion))
+    return np.isin(serie.cat.codes.to_numpy(), codigos_sel[codigos_sel >= 0])
+
+# --- Filtrado de Datos (cacheado) ---
+# Recibe los filtros como tuplas (hashables) y relee el DataFrame base desde
+# el load_data cacheado, así los reruns con la misma selección no repiten
+# los escaneos isin().
+@st.cache_data(show_spinner=False)
+def filter_data(csv_file_path, comunas, severidades, sexos, tipos_amp):
+    df = load_data(csv_file_path)
+
+    # El indexado booleano ya devuelve un DataFrame nuevo; no hace falta
+    # un .copy() adicional porque no mutamos el resultado
+    df_filtrado = df[
+        _mask_categorias(df['Comuna'], comunas)
+        & _mask_categorias(df['Ultima registro severidad'], severidades)
+        & _mask_categorias(df['Sexo (Desc)'], sexos)
+    ]
+
+    if tipos_amp:
+        # OR bit a bit sobre el bloque NumPy: evita la suma fila a fila
+        mask_amp = df_filtrado[list(tipos_amp)].to_numpy(dtype=bool).any(axis=1)
+        df_filtrado = df_filtrado[mask_amp]
+
+    return df_filtrado
+
+# Distribución de severidad por comuna, agregada una sola vez por estado de
+# filtros; el clic en una comuna solo indexa esta tabla
+@st.cache_data(show_spinner=False)
+def severity_counts_by_comuna(csv_file_path, filtros):
+    df = filter_data(csv_file_path, *filtros)
+    return (
+        df.groupby(['Comuna', 'Ultima registro severidad'], observed=True)
+        .size()
+        .reset_index(name='Total Casos')
+    )
+
+# --- Construcción del Mapa (cacheada) ---
+# Estilos de las capas GeoJSON, definidos una sola vez a nivel de módulo.
+# Las funciones de estilo devuelven siempre estos mismos dicts compartidos,
+# en vez de construir un dict nuevo por feature (folium evalúa la función
+# de estilo para cada feature al serializar y deduplica estilos idénticos).
+ESTILO_COMUNAS = {
+    'fillColor': '#222222',
+    'color': '#FFFFFF',
+    'weight': 1.5,
+    'fillOpacity': 0.1
+}
+RESALTADO_COMUNAS = {'weight': 3, 'color': 'yellow'}
+
+# Paleta única de severidad (en orden creciente), compartida por la capa
+# de puntos del mapa y el gráfico de barras por comuna
+COLORES_SEVERIDAD = {
+    'Menor': 'green',
+    'Moderada': 'orange',
+    'Mayor': 'red'
+}
+
+ESTILOS_PUNTO = {sev: {'fillColor': color} for sev, color in COLORES_SEVERIDAD.items()}
+ESTILO_PUNTO_DEFECTO = {'fillColor': 'gray'}
+
+def _estilo_comuna(feature):
+    return ESTILO_COMUNAS
+
+def _resaltado_comuna(feature):
+    return RESALTADO_COMUNAS
+
+def _estilo_punto(feature):
+    return ESTILOS_PUNTO.get(
+        feature['properties']['Ultima registro severidad'], ESTILO_PUNTO_DEFECTO)
+
+# Esqueleto del mapa (tiles base + polígonos comunales): no depende del
+# centro ni de los filtros de puntos, así que se construye una sola vez por
+# zoom y comunas visibles y cada render parte de una copia (el centro se
+# ajusta sobre la copia en build_map)
+@st.cache_resource(show_spinner=False, max_entries=8)
+def build_base_map(zoom, comunas_visibles, _gdf_comunas):
+    # location de relleno: folium descarta zoom_start si location es None;
+    # build_map pisa el centro sobre la copia antes de renderizar
+    mapa = folium.Map(location=(0.0, 0.0), zoom_start=zoom, prefer_canvas=True)
+
+    # --- Añadir los Bordes de Comunas (POLÍGONOS) ---
+    # Solo serializamos los polígonos de comunas con PPD visibles; las
+    # comunas fuera del filtro no aportan nada al mapa
+    if _gdf_comunas is not None:
+        gdf_visibles = _gdf_comunas[_gdf_comunas['Comuna_Corregida'].isin(comunas_visibles)]
+        folium.GeoJson(
+            gdf_visibles,
+            name='Bordes Comunales',
+            style_function=_estilo_comuna,
+            tooltip=folium.GeoJsonTooltip(
+                fields=['Comuna_Corregida'],
+                aliases=['Comuna:'],
+            ),
+            highlight_function=_resaltado_comuna,
+            popup=folium.GeoJsonPopup(
+                fields=['Comuna_Corregida'],
+                aliases=['Comuna:'],
+                localize=True
+            )
+        ).add_to(mapa)
+
+    return mapa
+
+# Mapa completo: copia el esqueleto cacheado y agrega encima la capa de
+# puntos; la llave incluye la selección de filtros y el hash de los datos,
+# así los reruns con filtros sin cambios reutilizan el mapa ya construido.
+@st.cache_resource(show_spinner=False, max_entries=16)
+def build_map(df_hash, filtros, center, zoom, _df_filtrado, _gdf_comunas):
+    comunas_visibles = tuple(sorted(_df_filtrado['Comuna'].unique()))
+    mapa = copy.deepcopy(build_base_map(zoom, comunas_visibles, _gdf_comunas))
+    # float() nativo: un np.float32 aquí rompe la serialización JSON del mapa
+    mapa.location = [float(c) for c in center]
+
+    # --- Creación de la Capa de Puntos (una sola capa GeoJSON) ---
+    # Popups construidos con una sola concatenación vectorizada de Series:
+    # cada feature embebe un único string HTML en vez de ocho propiedades
+    codigos = _df_filtrado['Codigo'].astype(str)
+    popups = (
+        "<b>Código PPD:</b> " + codigos + "<br>"
+        "<b>Comuna:</b> " + _df_filtrado['Comuna'].astype(str) + "<br>"
+        "<b>Sexo:</b> " + _df_filtrado['Sexo (Desc)'].astype(str) + "<br>"
+        "<b>Edad:</b> " + _df_filtrado['Ultima Edad Registrada'].astype(str) + "<br>"
+        "<b>Severidad:</b> " + _df_filtrado['Ultima registro severidad'].astype(str) + "<br>"
+        "<hr>"
+        "<b>Tiempo a HPM:</b> " + _df_filtrado['tiempo (minutos)'].round(1).astype(str) + " min<br>"
+        "<b>Distancia:</b> " + _df_filtrado['km'].round(1).astype(str) + " km<br>"
+        "<b>Total Amputaciones:</b> " + _df_filtrado['Total_Amputaciones'].astype(str) + "<br>"
+    )
+
+    gdf_puntos = gpd.GeoDataFrame(
+        {
+            'Codigo': codigos,
+            'popup_html': popups,
+            'Ultima registro severidad': _df_filtrado['Ultima registro severidad']
+        },
+        geometry=gpd.points_from_xy(_df_filtrado['lng'], _df_filtrado['lat']),
+        crs=4326
+    )
+
+    folium.GeoJson(
+        gdf_puntos,
+        name='PPD',
+        marker=folium.CircleMarker(radius=6, weight=1, color='#FFFFFF',
+                                   fill=True, fill_opacity=0.85),
+        style_function=_estilo_punto,
+        tooltip=folium.GeoJsonTooltip(fields=['Codigo'], aliases=['PPD:']),
+        popup=folium.GeoJsonPopup(fields=['popup_html'], labels=False)
+    ).add_to(mapa)
+
+    folium.LayerControl().add_to(mapa)
+    return mapa
+
 # --- Cargar los datos ---
 DATA_FILE = 'BASE TRABAJO FINAL.xlsx - Sheet1.csv'
 SHAPE_FILE = 'llanquihue_comunas.geojson'
@@ -73,56 +297,54 @@ st.sidebar.header('Panel de Filtros')
 
 # --- REFRESH BUTTON (NUEVO REQUISITO) ---
 # Creamos la lógica para el botón de reinicio
-if st.sidebar.button("🔄 Reiniciar Vista del Mapa"):
+if st.sidebar.button("🔄 Reiniciar Vista del Mapa", key='btn_reiniciar_vista'):
     if 'last_clicked_commune_center' in st.session_state:
         # Borramos el estado guardado del centro para forzar el centro inicial
         del st.session_state['last_clicked_commune_center']
     st.rerun() # Forzamos la recarga de la página
 
-comunas_disponibles = sorted(df_original['Comuna'].unique())
+# Las opciones salen directo de las categorías (ya ordenadas), sin
+# recalcular unique() + sorted() en cada rerun
+comunas_disponibles = list(df_original['Comuna'].cat.categories)
 comunas_seleccionadas = st.sidebar.multiselect(
     'Filtrar por Comuna:',
     options=comunas_disponibles,
-    default=comunas_disponibles
+    default=comunas_disponibles,
+    key='filtro_comunas'
 )
 
-severidad_disponible = sorted(df_original['Ultima registro severidad'].unique())
+severidad_disponible = list(df_original['Ultima registro severidad'].cat.categories)
 severidad_seleccionada = st.sidebar.multiselect(
     'Filtrar por Severidad:',
     options=severidad_disponible,
-    default=severidad_disponible
+    default=severidad_disponible,
+    key='filtro_severidad'
 )
 
-sexo_disponible = sorted(df_original['Sexo (Desc)'].unique())
+sexo_disponible = list(df_original['Sexo (Desc)'].cat.categories)
 sexo_seleccionado = st.sidebar.multiselect(
     'Filtrar por Sexo:',
     options=sexo_disponible,
-    default=sexo_disponible
+    default=sexo_disponible,
+    key='filtro_sexo'
 )
 
 st.sidebar.subheader('Filtrar por Tipo de Amputación')
 st.sidebar.info("Mostrar PPD que tengan CUALQUIERA de las amputaciones seleccionadas.")
 
-cols_amputacion = [
-    'AMP_DEDO_MANO', 'AMP_PULGAR', 'AMP_DEDO_PIE', 'AMP_A_NIVEL_PIE',
-    'DESART_TOBILLO', 'AMP_NIVEL_MALEOLO', 'AMP_DEBAJO_RODILLA',
-    'DESART_RODILLA', 'AMP_ENCIMA_RODILLA'
-]
-
 tipos_amp_seleccionados = []
-for col in cols_amputacion:
-    if st.sidebar.checkbox(col.replace("_", " ").title()):
+for col in COLS_AMPUTACION:
+    if st.sidebar.checkbox(col.replace("_", " ").title(), key=f'filtro_{col}'):
         tipos_amp_seleccionados.append(col)
 
 # --- Lógica de Filtrado ---
-df_filtrado = df_original[
-    (df_original['Comuna'].isin(comunas_seleccionadas)) &
-    (df_original['Ultima registro severidad'].isin(severidad_seleccionada)) &
-    (df_original['Sexo (Desc)'].isin(sexo_seleccionado))
-].copy()
-
-if tipos_amp_seleccionados:
-    df_filtrado = df_filtrado[df_filtrado[tipos_amp_seleccionados].sum(axis=1) > 0]
+filtros_key = (
+    tuple(sorted(comunas_seleccionadas)),
+    tuple(sorted(severidad_seleccionada)),
+    tuple(sorted(sexo_seleccionado)),
+    tuple(tipos_amp_seleccionados)
+)
+df_filtrado = filter_data(DATA_FILE, *filtros_key)
 
 
 # --- Área Principal: Métricas y Mapa ---
@@ -131,92 +353,37 @@ st.metric(label="Total PPD Encontrados", value=len(df_filtrado))
 if df_filtrado.empty:
     st.warning("No se encontraron PPD con los filtros seleccionados.")
 else:
-    lat_media = df_filtrado['lat'].mean()
-    lng_media = df_filtrado['lng'].mean()
-    
+    # Media directa en NumPy (las columnas ya son float32): evita la ruta
+    # NaN-safe de pandas; las filas sin coordenadas se descartaron en load_data
+    coords = df_filtrado[['lat', 'lng']].to_numpy()
+    lat_media, lng_media = (float(v) for v in coords.mean(axis=0))
+
+
     # Lógica para centrar el mapa en la comuna clicada si existe una en la sesión
     initial_center = [lat_media, lng_media]
     initial_zoom = 9
 
     if 'last_clicked_commune_center' in st.session_state:
         initial_center = st.session_state['last_clicked_commune_center']
-        initial_zoom = 10 
+        initial_zoom = 10
 
-    mapa = folium.Map(location=initial_center, zoom_start=initial_zoom)
+    df_hash = pd.util.hash_pandas_object(df_filtrado, index=False).sum()
 
-    # --- Añadir los Bordes de Comunas (POLÍGONOS) ---
-    if gdf_comunas is not None:
-        style_comunas = {
-            'fillColor': '#222222',
-            'color': '#FFFFFF',
-            'weight': 1.5,
-            'fillOpacity': 0.1
-        }
-        
-        folium.GeoJson(
-            gdf_comunas,
-            name='Bordes Comunales',
-            style_function=lambda x: style_comunas,
-            tooltip=folium.GeoJsonTooltip(
-                fields=['Comuna_Corregida'], 
-                aliases=['Comuna:'],
-            ),
-            highlight_function=lambda x: {'weight': 3, 'color': 'yellow'},
-            popup=folium.GeoJsonPopup(
-                fields=['Comuna_Corregida'], 
-                aliases=['Comuna:'],
-                localize=True
-            )
-        ).add_to(mapa)
-
-    # --- Creación de Capas de Puntos (Markers) ---
-    capas_severidad = {
-        'Mayor': folium.FeatureGroup(name='Severidad Mayor', show=True).add_to(mapa),
-        'Moderada': folium.FeatureGroup(name='Severidad Moderada', show=True).add_to(mapa),
-        'Menor': folium.FeatureGroup(name='Severidad Menor', show=True).add_to(mapa)
-    }
-    
-    colores_severidad = {
-        'Mayor': 'red',
-        'Moderada': 'orange',
-        'Menor': 'green'
-    }
-
-    for _, row in df_filtrado.iterrows():
-        popup_html = f"""
-        <b>Código PPD:</b> {row['Codigo']}<br>
-        <b>Comuna:</b> {row['Comuna']}<br>
-        <b>Sexo:</b> {row['Sexo (Desc)']}<br>
-        <b>Edad:</b> {row['Ultima Edad Registrada']}<br>
-        <b>Severidad:</b> {row['Ultima registro severidad']}<br>
-        <hr>
-        <b>Tiempo a HPM:</b> {row['tiempo (minutos)']:.1f} min<br>
-        <b>Distancia:</b> {row['km']:.1f} km<br>
-        <b>Total Amputaciones:</b> {row['Total_Amputaciones']}<br>
-        """
-        popup = folium.Popup(popup_html, max_width=300)
-        
-        severidad = row['Ultima registro severidad']
-        color = colores_severidad.get(severidad, 'gray')
-        
-        marcador = folium.Marker(
-            location=[row['lat'], row['lng']],
-            popup=popup,
-            tooltip=f"PPD: {row['Codigo']}",
-            icon=folium.Icon(color=color, icon='user', prefix='fa')
-        )
-        
-        if severidad in capas_severidad:
-            marcador.add_to(capas_severidad[severidad])
-
-    folium.LayerControl().add_to(mapa)
+    mapa = build_map(
+        df_hash, filtros_key,
+        tuple(initial_center), initial_zoom,
+        df_filtrado, gdf_comunas
+    )
 
     # --- Mostrar el Mapa y CAPTURAR la interacción del usuario ---
+    # Key estable: un key que cambia con los filtros destruye y recrea el
+    # componente (y su estado de zoom/paneo) en cada interacción
     map_data = st_folium(
-        mapa, 
-        width=1000, 
-        height=600, 
-        key=f"map_{len(df_filtrado)}_{initial_zoom}"
+        mapa,
+        width=1000,
+        height=600,
+        key='mapa_principal',
+        returned_objects=['last_active_object']
     )
 
     # --- LÓGICA DE CLIC EN COMUNA (GRÁFICO Y TABLA RESUMEN) ---
@@ -229,15 +396,17 @@ else:
             if not df_comuna.empty:
                 st.markdown(f"## 📊 Análisis y Resumen de **{clicked_commune}**")
                 
-                # Opcional: Centrar el mapa en la comuna clicada (guarda el centro para el próximo renderizado)
-                center_lat = df_comuna['lat'].mean()
-                center_lng = df_comuna['lng'].mean()
+                # Guardamos el centro de la comuna clicada: el próximo rerun
+                # natural (cualquier interacción) centrará el mapa ahí, sin
+                # forzar un st.rerun() que duplicaría todo el render y
+                # cortaría la ejecución antes del gráfico y la tabla
+                center_lat = float(df_comuna['lat'].mean())
+                center_lng = float(df_comuna['lng'].mean())
                 st.session_state['last_clicked_commune_center'] = [center_lat, center_lng]
-                # Forzamos la recarga para que el mapa se centre
-                st.rerun() 
 
                 # --- 1. Generación del Gráfico de Barras (RE-AGREGADO) ---
-                df_chart = df_comuna.groupby('Ultima registro severidad').size().reset_index(name='Total Casos')
+                df_severidad = severity_counts_by_comuna(DATA_FILE, filtros_key)
+                df_chart = df_severidad[df_severidad['Comuna'] == clicked_commune]
                 
                 fig = px.bar(
                     df_chart,
@@ -246,14 +415,10 @@ else:
                     color='Ultima registro severidad',
                     title=f'Distribución de Severidad en {clicked_commune}',
                     labels={'Ultima registro severidad': 'Severidad', 'Total Casos': 'Número de Casos'},
-                    color_discrete_map={
-                        'Mayor': 'red',
-                        'Moderada': 'orange',
-                        'Menor': 'green'
-                    }
+                    color_discrete_map=COLORES_SEVERIDAD
                 )
                 # Ordenar las barras: Menor, Moderada, Mayor
-                fig.update_layout(xaxis={'categoryorder':'array', 'categoryarray':['Menor', 'Moderada', 'Mayor']})
+                fig.update_layout(xaxis={'categoryorder': 'array', 'categoryarray': list(COLORES_SEVERIDAD)})
                 st.plotly_chart(fig, use_container_width=True)
 
                 # --- 2. Cuadro Resumen (Tabla de PPD) ---